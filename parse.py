@@ -24,9 +24,91 @@ parse.py - *toy* parser and examples for simple boolean-like statements such as;
     production use.
 
 """
+from array import array
+import functools
 import logging
+import re
 import sys
 
+# Token kinds produced by _tokenize(), AND/OR/NOT/COND are also the tags of the nodes
+# built by Parse.compile(), e.g. (AND, left, right), (NOT, node), (COND, 'x<y')
+LPAREN = 'lparen'
+RPAREN = 'rparen'
+AND = 'and'
+OR = 'or'
+NOT = 'not'
+COND = 'cond'
+
+# Opcodes emitted by Parse._emit() and run by Parse._run(), PUSH_COND and the jumps take one argument
+PUSH_COND = 0       # PUSH_COND idx: push the result of testing condition idx
+NEGATE = 1          # negate the top of the stack
+JUMP_IF_FALSE = 2   # JUMP_IF_FALSE pc: jump to pc if the top of the stack is False, otherwise pop it
+JUMP_IF_TRUE = 3    # JUMP_IF_TRUE pc: jump to pc if the top of the stack is True, otherwise pop it
+
+# OR binds tighter than AND, so "a and b or c" is "a and (b or c)"
+_PRECEDENCE = {NOT: 3, OR: 2, AND: 1}
+
+# Operators are delimited by whitespace, a parenthesis or the start / end of the statement,
+# e.g. "a and (b)", "(a)or(b)", "not(a)"
+_TOKEN_RE = re.compile(r'(?P<lparen>\()|(?P<rparen>\))|'
+                       r'(?P<and>(?:^|\s+|(?<=[\s()]))and(?:\s+|$|(?=[()])))|'
+                       r'(?P<or>(?:^|\s+|(?<=[\s()]))or(?:\s+|$|(?=[()])))|'
+                       r'(?P<not>(?:^|\s+|(?<=[\s()]))not(?:\s+|$|(?=[()])))|'
+                       r'(?P<cond>[^()]+?(?=\s+(?:and|or)(?:\s+|$|[()])|\)|$))', re.I)
+
+# Upper case " AND " / " OR " / " NOT " in a section, lower-cased by Parse.eval_section()
+_CASE_RE = re.compile(r'(?<= )(?:AND|OR|NOT)(?= )')
+
+
+@functools.lru_cache(maxsize=1024)
+def _tokenize(expr):
+    """Split expr into a tuple of (kind, value) tuples in a single regex scan, kind is one of
+    LPAREN, RPAREN, AND, OR, NOT or COND.  Results are cached per statement, so statements
+    that are compiled again (by another Parse instance, or after another statement was
+    checked) are not re-scanned.  Raises ValueError for any text that isn't part of a token."""
+    tokens = []
+    end = 0
+    for match in _TOKEN_RE.finditer(expr):
+        if expr[end:match.start()].strip():
+            raise ValueError('Unexpected "{0}" in "{1}"'.format(expr[end:match.start()].strip(), expr))
+        end = match.end()
+        kind = match.lastgroup
+        if kind == COND:
+            value = match.group().strip()
+            if not value:
+                continue
+        else:
+            value = kind
+        tokens.append((kind, value))
+    if expr[end:].strip():
+        raise ValueError('Unexpected "{0}" in "{1}"'.format(expr[end:].strip(), expr))
+    return tuple(tokens)
+
+
+@functools.lru_cache(maxsize=4096)
+def _int_cmp(condition):
+    """Evaluate "x<y" or "x>y" where x and y are ints, for Parse.evaluate().  Results are cached
+    per condition string, so repeated conditions are only split and converted once."""
+    lhs, sep, rhs = condition.partition('<')
+    if sep:
+        if '<' in rhs or '>' in condition:
+            raise ValueError('Condition "{0}" is not x<y'.format(condition))
+        try:
+            return int(lhs) < int(rhs)
+        except ValueError:
+            raise ValueError('Condition "{0}" is not (int)<(int)'.format(condition))
+
+    lhs, sep, rhs = condition.partition('>')
+    if sep:
+        if '>' in rhs:
+            raise ValueError('Condition "{0}" is not x>y'.format(condition))
+        try:
+            return int(lhs) > int(rhs)
+        except ValueError:
+            raise ValueError('Condition "{0}" is not (int)>(int)'.format(condition))
+
+    raise ValueError('Condition "{0}" is not x>y or x<y'.format(condition))
+
 
 class Parse:
     """Simple parser for statements like: "condition1 or condition2 and (condition3 or condition4)"
@@ -40,6 +122,15 @@ class Parse:
     dry_run = False
     logger = None
     data = None
+    expr = None
+    _ast = None
+    _code = None
+    _consts = None
+
+    # separators used by eval_section() / test()
+    _AND = ' and '
+    _OR = ' or '
+    _NOT = 'not '
 
     def __init__(self, data=None, dry_run=False, log_level=logging.ERROR, logger=None):
         """
@@ -50,18 +141,23 @@ class Parse:
         """
         self.dry_run = dry_run
         self.data = data
-        if type(log_level) == int and log_level >= 0:
+        self._eval_cache = {}
+        if isinstance(log_level, int) and log_level >= 0:
             self.log_level = log_level
         else:
-            print("\n!!\tinit: log_level {0} not valid, ignoring it".format(log_level))
+            self.log_level = logging.ERROR
+            print("\n!!\tinit: log_level {0} not valid, using logging.ERROR".format(log_level))
         if logger is not None:
             if not hasattr(logger, 'debug'):
                 print("\n!!\tinit: logger {0} not a valid logging.getLogger, using stdout".format(logger))
             else:
                 self.logger = logger
 
-    def log(self, level, msg):
+    def log(self, level, msg, *args):
+        """Log msg at level, msg is only %-formatted with args if level is enabled."""
         if self.log_level <= level:
+            if args:
+                msg = msg % args
             if self.logger is None:
                 print(msg)
             else:
@@ -70,116 +166,203 @@ class Parse:
     def parse(self, expr):
         """Parse expr: use for checking syntax."""
         self.raw_expr = expr
-        self.expr = expr
+        self._eval_cache = {}
 
         # condition and (condition or (condition and condition))
 
-        # equivalent to;
-        # TRUE|FALSE and (TRUE|FALSE or (TRUE|FALSE and TRUE|FALSE))
+        # is split once into tokens;
+        # COND AND LPAREN COND OR LPAREN COND AND COND RPAREN RPAREN
+
+        # which are compiled into a tree, operators wait on a stack until their right-hand side
+        # is complete (or their closing parenthesis is reached);
+        # (AND, COND, (OR, COND, (AND, COND, COND)))
 
-        # evaluate everything in brackets;
-        # (TRUE|FALSE or (TRUE|FALSE and TRUE|FALSE))
-        # evaluate first:     (TRUE|FALSE and TRUE|FALSE)
-        #       becomes TRUE|FALSE, so outer expression becomes;
-        # (TRUE|FALSE or TRUE|FALSE), which evaluates to;
-        # TRUE|FALSE
+        # and then into a flat list of opcodes, where AND/OR become jumps past their right-hand
+        # side, so a condition is only tested if the result still depends on it;
+        # PUSH_COND 0, JUMP_IF_FALSE 14, PUSH_COND 1, JUMP_IF_TRUE 14, PUSH_COND 2, JUMP_IF_FALSE 14, PUSH_COND 3
 
-        self.log(logging.DEBUG, 'INPUT expression:\n{0}'.format(self.expr))
-        self.simplify_parens(self.expr, 0)
-        self.log(logging.DEBUG, '\nINPUT:\n{0}\nSIMPLIFIED to:\n{1}'.format(self.raw_expr, self.expr))
-        return self.test(self.eval_section(self.expr))
+        self.log(logging.DEBUG, 'INPUT expression:\n%s', expr)
+        self.compile(expr)
+        self.log(logging.DEBUG, '\nINPUT:\n%s\nCOMPILED to:\n%s\n%s\n%s',
+                 self.raw_expr, self._ast, self._code, self._consts)
+        return self._run()
 
     def check_match(self, expr, data):
+        """Test expr against data.  expr is only compiled if it differs from the last one, so the
+        same statement can be checked against many data objects cheaply."""
         self.data = data
+        self._eval_cache = {}
+        if self._code is None or expr != self.expr:
+            self.compile(expr)
+        return self._run()
+
+    def compile(self, expr):
+        """Compile expr into a tree of (tag, ...) tuples, which is stored as self._ast and returned.
+        e.g. "a and not (b or c)" becomes;
+            ('and', ('cond', 'a'), ('not', ('or', ('cond', 'b'), ('cond', 'c'))))
+        The tree is also lowered to opcodes in self._code, with the conditions in self._consts.
+        """
         self.expr = expr
-        self.simplify_parens(self.expr, 0)
-        return self.test(self.eval_section(self.expr))
-
-    def simplify_parens(self, expr, nesting=0):
-        if '(' not in expr:
-            return
-
-        this_eval = expr
-
-        current_expr = ''
-
-        in_paren = False
-
-        section_index = 0
-
-        for c in this_eval:
-            if in_paren:
-                if c == ')':
-                    in_paren = False
-                    self.log(logging.DEBUG, '{0}: section: {1}'.format(nesting, current_expr))
-                    if '(' in current_expr:
-                        current_expr += c
-                        # there are more nested parens in this section
-                        self.simplify_parens(current_expr, nesting+1)
-                    else:
-                        # current stack is for evaluation
-                        self.log(logging.DEBUG, '{0}: EVAL {1}'.format(nesting, current_expr))
-                        paren_result = self.eval_section(current_expr)
-                        self.log(logging.DEBUG, '{0}: section result: {1}'.format(nesting, paren_result))
-                        self.expr = self.expr.replace('(' + current_expr + ')', paren_result)
-                        self.log(logging.DEBUG, '{0}: current expr: {1}'.format(nesting, self.expr))
-                        if '(' in self.expr:
-                            self.simplify_parens(self.expr, nesting + 1)
+        self._ast = None
+        self._code = None
+        operands = []
+        ops = []
+        # True when the next token has to start an operand (COND, LPAREN or NOT), False when it has
+        # to follow one (RPAREN, AND or OR), so "()", "a and" or "(a) (b)" are rejected
+        expect_operand = True
+        for kind, value in _tokenize(expr):
+            if (kind == COND or kind == LPAREN or kind == NOT) != expect_operand:
+                raise ValueError('"{0}" is not a valid statement'.format(expr))
+            if kind == COND:
+                operands.append((COND, value))
+                expect_operand = False
+            elif kind == LPAREN or kind == NOT:
+                # NOT is a prefix operator, it can only be applied once its operand is complete
+                ops.append(kind)
+            elif kind == RPAREN:
+                while ops and ops[-1] != LPAREN:
+                    self._reduce(ops.pop(), operands)
+                if not ops:
+                    raise ValueError('Unbalanced ")" in "{0}"'.format(expr))
+                ops.pop()
+            else:
+                while ops and ops[-1] != LPAREN and _PRECEDENCE[ops[-1]] >= _PRECEDENCE[kind]:
+                    self._reduce(ops.pop(), operands)
+                ops.append(kind)
+                expect_operand = True
+
+        if expect_operand:
+            raise ValueError('"{0}" is not a valid statement'.format(expr))
+        while ops:
+            op = ops.pop()
+            if op == LPAREN:
+                raise ValueError('Unbalanced "(" in "{0}"'.format(expr))
+            self._reduce(op, operands)
+
+        if len(operands) != 1:
+            raise ValueError('"{0}" is not a valid statement'.format(expr))
+        self._ast = operands[0]
+        code = array('i')
+        self._consts = []
+        self._emit(self._ast, code, self._consts)
+        self._code = code
+        return self._ast
+
+    def _reduce(self, op, operands):
+        """Replace the operand(s) of op at the top of the operand stack with a single op node."""
+        if len(operands) < (1 if op == NOT else 2):
+            raise ValueError('"{0}" is not a valid statement'.format(self.expr))
+        if op == NOT:
+            operands.append((NOT, operands.pop()))
+        else:
+            right = operands.pop()
+            operands.append((op, operands.pop(), right))
+
+    @staticmethod
+    def _emit(node, code, consts):
+        """Append the opcodes for node to code, adding its conditions to consts.  Works through an
+        explicit stack of pending nodes / opcodes rather than recursing, so deeply nested statements
+        can't hit the recursion limit."""
+        # pending holds nodes still to emit, opcodes (int) to append, or None to patch the most
+        # recent unpatched jump to the current end of code
+        pending = [node]
+        jumps = []
+        while pending:
+            item = pending.pop()
+            if item is None:
+                code[jumps.pop()] = len(code)
+            elif type(item) is int:
+                code.append(item)
+                if item != NEGATE:
+                    code.append(0)
+                    jumps.append(len(code) - 1)
+            elif item[0] == COND:
+                code.append(PUSH_COND)
+                code.append(len(consts))
+                consts.append(item[1])
+            elif item[0] == NOT:
+                pending.append(NEGATE)
+                pending.append(item[1])
+            else:
+                # the left-hand side decides the result if it is False for AND / True for OR,
+                # in which case jump past the right-hand side
+                pending.append(None)
+                pending.append(item[2])
+                pending.append(JUMP_IF_FALSE if item[0] == AND else JUMP_IF_TRUE)
+                pending.append(item[1])
+
+    def _run(self):
+        """Run the opcodes from compile() and return the result.  A jump that isn't taken discards
+        the value it tested, so there is never more than one value on the stack and it is kept in
+        a local instead."""
+        code = self._code
+        consts = self._consts
+        test = self.test
+        debug = self.log_level <= logging.DEBUG
+        end = len(code)
+        result = None
+        pc = 0
+        while pc < end:
+            op = code[pc]
+            if op == PUSH_COND:
+                result = test(consts[code[pc + 1]])
+                pc += 2
+            elif op == NEGATE:
+                result = not result
+                pc += 1
+            elif op == JUMP_IF_FALSE:
+                if result:
+                    pc += 2
                 else:
-                    current_expr += c
+                    if debug:
+                        self.log(logging.DEBUG, '\tAND section is FALSE at %s', pc)
+                    pc = code[pc + 1]
             else:
-                if c == '(':
-                    self.log(logging.DEBUG, '\tNew parentheses section')
-                    current_expr = ''
-                    in_paren = True
-
-            section_index += 1
-
-            continue
+                if result:
+                    if debug:
+                        self.log(logging.DEBUG, '\tOR section is TRUE at %s', pc)
+                    pc = code[pc + 1]
+                else:
+                    pc += 2
+        return result
 
     def eval_section(self, section):
+        """Evaluate a section without parentheses, returns (bool).
+        Kept for compatibility, parse() / check_match() don't use it."""
+        self._eval_cache = {}
 
         # parse LTR "condition"
         # optional AND / OR / NOT and then more "condition"
         #
-        section = section.replace(' AND ', ' and ').replace(' OR ', ' or ').replace(' NOT ', ' not ')
+        section = _CASE_RE.sub(lambda m: m.group().lower(), section)
         # AND conditions first, all must eval to true
-        and_parts = section.split(' and ')
-        self.log(logging.DEBUG, '\tAND sections: {0}'.format(and_parts))
-        true_parts = 0
+        and_parts = section.split(self._AND)
+        self.log(logging.DEBUG, '\tAND sections: %s', and_parts)
         for part in and_parts:
-            if ' or ' in part:
-                # This section is TRUE if ANY of the OR parts are TRUE
-                for or_part in part.split(' or '):
-                    if self.test(or_part):
-                        true_parts += 1
-                        self.log(logging.DEBUG, '\tOR section "{0}" is TRUE'.format(part))
-                        break
-
+            or_parts = part.split(self._OR)
+            if len(or_parts) > 1:
+                # This section is TRUE if ANY of the OR parts are TRUE, any() stops at the first
+                ok = any(self.test(or_part) for or_part in or_parts)
+                self.log(logging.DEBUG, '\tOR section "%s" is %s', part, 'TRUE' if ok else 'FALSE')
             else:
                 # This section is TRUE if this part is TRUE
-                if self.test(part):
-                    self.log(logging.DEBUG, '\tAND section "{0}" is TRUE'.format(part))
-                    true_parts += 1
-                else:
-                    self.log(logging.DEBUG, '\tAND section "{0}" is FALSE'.format(part))
+                ok = self.test(part)
+                self.log(logging.DEBUG, '\tAND section "%s" is %s', part, 'TRUE' if ok else 'FALSE')
 
-        if true_parts == len(and_parts):
-            # All TRUE, so return as TRUE
-            return '__TRUE__'
-        else:
-            return '__FALSE__'
+            if not ok:
+                # All AND parts must be TRUE, no need to look at the rest
+                return False
+
+        return True
 
     def test(self, s):
-        """Test if a section (with/without NOT) is True"""
-        if s == '__TRUE__':
-            return True
-        elif s == '__FALSE__':
-            return False
+        """Test if a section (with/without NOT) is True, s may also be an already evaluated (bool)"""
+        if s is True or s is False:
+            return s
         else:
-            if s.startswith('not '):
+            if s.startswith(self._NOT):
                 must_negate = True
-                s = s.lstrip('not ').strip()
+                s = s[len(self._NOT):].strip()
             else:
                 must_negate = False
                 s = s.strip()
@@ -187,7 +370,11 @@ class Parse:
             if self.dry_run:
                 return True
             else:
-                eval_result = self.evaluate(s)
+                # each distinct condition is only evaluated once per parse() / check_match()
+                if s in self._eval_cache:
+                    eval_result = self._eval_cache[s]
+                else:
+                    eval_result = self._eval_cache[s] = self.evaluate(s)
                 if must_negate:
                     return True if eval_result is False else False
                 else:
@@ -203,48 +390,46 @@ class Parse:
         :return: (bool)
         """
 
-        if '<' in condition:
-            parts = condition.split('<')
-            if len(parts) != 2:
-                raise ValueError('Condition "{0}" is not x<y'.format(condition))
-            try:
-                return int(parts[0]) < int(parts[1])
-            except:
-                raise ValueError('Condition "{0}" is not (int)<(int)'.format(condition))
-        elif '>' in condition:
-            parts = condition.split('>')
-            if len(parts) != 2:
-                raise ValueError('Condition "{0}" is not x>y'.format(condition))
-            try:
-                return int(parts[0]) > int(parts[1])
-            except:
-                raise ValueError('Condition "{0}" is not (int)>(int)'.format(condition))
-        else:
-            raise ValueError('Condition "{0}" is not x>y or x<y'.format(condition))
+        return _int_cmp(condition)
 
 
 class CustomParse(Parse):
     """Example evaluate section.  Condition for evaluate() is expected to be
-    userX.attr=str based on self.data set in evaluate()"""
+    userX.attr=str based on self.data.  If no data is given (None or "") the example users in
+    example_data are used instead, an empty dict means there are no users."""
+
+    example_data = {'user1': {'name': 'alice', 'height': 1.8},
+                    'user2': {'name': 'bob', 'height': 1.65},
+                    }
+
+    def __init__(self, data=None, dry_run=False, log_level=logging.ERROR, logger=None):
+        super().__init__(data=data, dry_run=dry_run, log_level=log_level, logger=logger)
+        # condition -> (user_key, attr, test), conditions only need splitting once
+        self._cond_cache = {}
+
     def evaluate(self, condition):
         """Example - alternate evaluate()"""
-        self.data = {'user1': {'name': 'alice', 'height': 1.8},
-                     'user2': {'name': 'bob', 'height': 1.65},
-                     }
-
-        if '.' not in condition:
-            raise ValueError("{0} invalid".format(condition))
-
-        cond_parts = condition.split('.')
-        if cond_parts[0] in self.data.keys():
-            user = self.data[cond_parts[0]]
-            attr, test = cond_parts[1].split('=')
-            if attr in user.keys():
+        parsed = self._cond_cache.get(condition)
+        if parsed is None:
+            if '.' not in condition or '=' not in condition:
+                raise ValueError("{0} invalid".format(condition))
+            user_key, rest = condition.split('.', 1)
+            attr, test = rest.split('=', 1)
+            parsed = self._cond_cache[condition] = (user_key, attr, test)
+        else:
+            user_key, attr, test = parsed
+
+        data = self.example_data if self.data is None or self.data == '' else self.data
+        if not hasattr(data, 'keys'):
+            raise ValueError("data {0} is not a dict of users".format(data))
+        if user_key in data:
+            user = data[user_key]
+            if attr in user:
                 return user[attr] == test
             else:
-                raise ValueError("attr {0} in {1} not recognised".format(cond_parts[attr], condition))
+                raise ValueError("attr {0} in {1} not recognised".format(attr, condition))
         else:
-            raise ValueError("{0} in {1} not recognised".format(cond_parts[0], condition))
+            raise ValueError("{0} in {1} not recognised".format(user_key, condition))
 
 
 def main():
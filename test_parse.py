@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+"""
+Regression checks for parse.py, run with;
+    python3 -m unittest test_parse
+"""
+import unittest
+
+import parse
+
+
+class CountingParse(parse.Parse):
+    """Parse that records every condition passed to evaluate()"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.evaluated = []
+
+    def evaluate(self, condition):
+        self.evaluated.append(condition)
+        return super().evaluate(condition)
+
+
+class TestCheckMatch(unittest.TestCase):
+
+    def check(self, expr):
+        return parse.Parse().check_match(expr, '')
+
+    def test_demo(self):
+        self.assertTrue(self.check("1<2 and (1<2 and (3>4 or 6<7)) or (0<1 and 10>10)"))
+
+    def test_not(self):
+        self.assertFalse(self.check('not 1<2'))
+        self.assertFalse(self.check('not (1<2 or 3>4)'))
+        self.assertTrue(self.check('1<2 and not (3>4)'))
+        self.assertTrue(self.check('not not 1<2'))
+
+    def test_or_binds_tighter_than_and(self):
+        # "a and b or c" is "a and (b or c)"
+        self.assertFalse(self.check('3>4 and 1<2 or 1<2'))
+        self.assertFalse(self.check('1<2 OR 3>4 AND 4>5'))
+
+    def test_parentheses_next_to_operators(self):
+        self.assertFalse(self.check('not(1<2)'))
+        self.assertFalse(self.check('1>2 and(1<2)'))
+        self.assertTrue(self.check('(3>4)or(1<2)'))
+        self.assertFalse(self.check('1<2 AND NOT(1<2)'))
+
+    def test_short_circuit_and_memoize(self):
+        p = CountingParse()
+        self.assertFalse(p.check_match('3>4 and (1<2 or 6<7)', ''))
+        self.assertEqual(p.evaluated, ['3>4'])
+        p.evaluated = []
+        self.assertTrue(p.check_match('1<2 and (1<2 or 6<7)', ''))
+        self.assertEqual(p.evaluated, ['1<2'])
+
+    def test_deep_nesting(self):
+        expr = '1<2'
+        for _ in range(5000):
+            expr = '1<2 and (' + expr + ')'
+        self.assertTrue(self.check(expr))
+
+
+class TestInvalidStatements(unittest.TestCase):
+
+    invalid = [
+        # operators without an operand
+        '1<2 and', 'and 1<2', '(1<2 or)', 'not', '1<2 and not', '(not) and 1<2', '1<2 and and 3>4',
+        '1<2 and ()', '( not )', '1<2 or ( or 2<3)', '()', '',
+        # operands without an operator between them
+        '1>2 (1<2)', '(1<2) (3>4) or ()',
+        # unbalanced parentheses
+        '(1<2', '1<2)', '((1<2)',
+    ]
+
+    def test_dry_run_rejects(self):
+        for expr in self.invalid:
+            with self.subTest(expr=expr):
+                self.assertRaises(ValueError, parse.Parse(dry_run=True).parse, expr)
+
+    def test_check_match_rejects(self):
+        for expr in self.invalid:
+            with self.subTest(expr=expr):
+                self.assertRaises(ValueError, parse.Parse().check_match, expr, '')
+
+    def test_custom_parse_rejects(self):
+        self.assertRaises(ValueError, parse.CustomParse().check_match, 'user1.name=alice and', '')
+
+
+class TestCustomParse(unittest.TestCase):
+
+    def test_example_users_without_data(self):
+        for data in [None, '']:
+            with self.subTest(data=data):
+                self.assertTrue(parse.CustomParse().check_match('user1.name=alice or user2.name=carol', data))
+
+    def test_given_data(self):
+        data = {'user1': {'name': 'carol'}}
+        self.assertFalse(parse.CustomParse().check_match('user1.name=alice', data))
+        self.assertTrue(parse.CustomParse().check_match('user1.name=carol', data))
+
+    def test_empty_dict_has_no_users(self):
+        self.assertRaises(ValueError, parse.CustomParse().check_match, 'user1.name=alice', {})
+
+    def test_data_not_a_dict(self):
+        self.assertRaises(ValueError, parse.CustomParse().check_match, 'user1.name=alice', 5)
+
+
+class TestEvaluate(unittest.TestCase):
+
+    def test_int_comparison(self):
+        p = parse.Parse()
+        self.assertTrue(p.evaluate('1<2'))
+        self.assertFalse(p.evaluate('10>10'))
+        for condition in ['1<2<3', '1<2>3', 'a<1', '12']:
+            with self.subTest(condition=condition):
+                self.assertRaises(ValueError, p.evaluate, condition)
+
+
+if __name__ == '__main__':
+    unittest.main()